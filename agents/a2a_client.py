@@ -4,9 +4,48 @@ This module provides small helper functions an AI agent (or test harness)
 can import and use to call your local Flight Agent service using JSON-RPC
 2.0 or the messages.parts A2A style.
 """
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
+import itertools
+import os
+import orjson
 import requests
-import uuid
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def _make_session() -> requests.Session:
+    """Build a Session with pooled keep-alive connections and retries on gateway errors.
+
+    Every helper POSTs a flight search, which is a read that is safe to
+    repeat, so POST is allowed for status-based retries (urllib3 leaves it
+    out by default). Once retries run out the last response is returned and
+    the helper's raise_for_status() reports it.
+    """
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# shared across calls so repeated RPCs reuse TCP/TLS connections
+_SESSION = _make_session()
+
+# JSON-RPC ids only need to be unique per caller: a pid prefix plus a counter
+# avoids a urandom read per call while staying unique across processes
+_RPC_ID_PREFIX = f"{os.getpid()}-"
+_RPC_IDS = itertools.count(1)
+
+
+def _next_rpc_id() -> str:
+    return _RPC_ID_PREFIX + str(next(_RPC_IDS))
 
 
 def call_flight_search(a2a_url: str, destination: str, date: str, adults: int = 1, origin: Optional[str] = None, currency: str = "NGN", headers: Optional[Dict[str, str]] = None, timeout: int = 10) -> Dict[str, Any]:
@@ -14,7 +53,7 @@ def call_flight_search(a2a_url: str, destination: str, date: str, adults: int =
 
     Returns the parsed JSON-RPC response 'result' field or raises on error.
     """
-    rpc_id = str(uuid.uuid4())
+    rpc_id = _next_rpc_id()
     payload = {
         "jsonrpc": "2.0",
         "id": rpc_id,
@@ -35,20 +74,46 @@ def call_flight_search(a2a_url: str, destination: str, date: str, adults: int =
     if headers:
         hdrs.update(headers)
 
-    resp = requests.post(a2a_url, json=payload, headers=hdrs, timeout=timeout)
+    resp = _SESSION.post(a2a_url, data=orjson.dumps(payload), headers=hdrs, timeout=timeout)
     resp.raise_for_status()
-    body = resp.json()
+    body = orjson.loads(resp.content)
     if "error" in body:
         raise RuntimeError(f"A2A RPC error: {body['error']}")
     return body.get("result")
 
 
+def call_flight_search_batch(a2a_url: str, queries: List[Dict[str, Any]], headers: Optional[Dict[str, str]] = None, timeout: int = 10) -> List[Dict[str, Any]]:
+    """Run several flight searches in one JSON-RPC call using params.queries.
+
+    Each item is a query dict (destination, date, adults, ...). The server runs
+    them concurrently; returns the list of per-query results in request order.
+    """
+    rpc_id = _next_rpc_id()
+    payload = {
+        "jsonrpc": "2.0",
+        "id": rpc_id,
+        "method": "flight/search",
+        "params": {"queries": list(queries)},
+    }
+
+    hdrs = {"Content-Type": "application/json"}
+    if headers:
+        hdrs.update(headers)
+
+    resp = _SESSION.post(a2a_url, data=orjson.dumps(payload), headers=hdrs, timeout=timeout)
+    resp.raise_for_status()
+    body = orjson.loads(resp.content)
+    if "error" in body:
+        raise RuntimeError(f"A2A RPC error: {body['error']}")
+    return (body.get("result") or {}).get("results", [])
+
+
 def send_message_parts(a2a_url: str, data: Dict[str, Any], text: Optional[str] = None, headers: Optional[Dict[str, str]] = None, timeout: int = 10) -> Dict[str, Any]:
     """Call the /a2a/flight endpoint using A2A-style message.parts payload.
 
     The `data` argument should be a dict that will be sent as a part with kind 'data'.
     """
-    rpc_id = str(uuid.uuid4())
+    rpc_id = _next_rpc_id()
     parts = []
     if text:
         parts.append({"kind": "text", "text": text})
@@ -67,13 +132,13 @@ def send_message_parts(a2a_url: str, data: Dict[str, Any], text: Optional[str] =
     if headers:
         hdrs.update(headers)
 
-    resp = requests.post(a2a_url, json=payload, headers=hdrs, timeout=timeout)
+    resp = _SESSION.post(a2a_url, data=orjson.dumps(payload), headers=hdrs, timeout=timeout)
     resp.raise_for_status()
-    body = resp.json()
+    body = orjson.loads(resp.content)
     if "error" in body:
         raise RuntimeError(f"A2A RPC error: {body['error']}")
     return body.get("result")
 
 
 if __name__ == "__main__":
-    print("A2A client helper module. Import and call call_flight_search() or send_message_parts() from your agent.")
+    print("A2A client helper module. Import and call call_flight_search(), call_flight_search_batch() or send_message_parts() from your agent.")
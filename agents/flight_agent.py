@@ -3,13 +3,111 @@
 This agent is intentionally lightweight so importing the module won't require
 external dependencies. Implement your real logic inside `find_cheapest`.
 """
-from typing import Optional, Dict, Any, List, Tuple
-import json
-import urllib.request
+from typing import Optional, Dict, Any, List, Literal
 import urllib.parse
-import socket
-import os
-import requests
+import re
+import asyncio
+import heapq
+import threading
+import weakref
+from collections import deque
+import httpx
+import ijson
+import orjson
+from cachetools import TLRUCache, TTLCache
+from models import FlightQuery, derive_ttl
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+
+# sentinel cached for searches whose provider call just failed
+_NEG = object()
+_NEGATIVE_TTL = 30
+
+
+def _flight_ttu(key, value, now):
+    """Expiry for a flight cache entry: short for failures, date-based otherwise."""
+    return now + (_NEGATIVE_TTL if value is _NEG else derive_ttl(key[2]))
+
+
+# FlightAPI.io results keyed by (origin, dest, date, adults, currency) with a
+# per-entry expiry from _flight_ttu(). Failures are stored as _NEG for a few
+# seconds so a degraded provider isn't hammered by repeats of the same search.
+_FLIGHT_CACHE: TLRUCache = TLRUCache(maxsize=4096, ttu=_flight_ttu)
+# ipapi.co lookups; the caller's location rarely changes so keep them for hours.
+_GEO_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=6 * 3600)
+_CACHE_LOCK = threading.Lock()
+
+_GEO_URL = "https://ipapi.co/json/"
+_ONEWAYTRIP_URL = "https://api.flightapi.io/onewaytrip/{key}/{o}/{d}/{date}/{adults}/{cur}"
+_ONEWAY_URL = "https://api.flightapi.io/oneway/{key}/{o}/{d}/{date}/{adults}"
+_HEADERS = {"User-Agent": "FlightAgent/1.0"}
+
+# simple city -> IATA map (extend as needed); keys are lowercase so lookups
+# are case-insensitive
+_IATA_MAP = {k.lower(): v for k, v in {
+    "Lagos": "LOS", "London": "LHR", "Abuja": "ABV",
+    "New York": "JFK", "Toronto": "YYZ", "Seoul": "ICN",
+    "Los Angeles": "LAX", "San Francisco": "SFO", "Paris": "CDG",
+}.items()}
+
+
+def _as_iata_code(value: Any) -> Optional[str]:
+    """Return `value` upper-cased if it looks like a 3-letter IATA code, else None."""
+    if isinstance(value, str) and len(value) == 3 and value.isalpha():
+        return value.upper()
+    return None
+
+
+def _city_to_iata(city: Any) -> Optional[str]:
+    """Look up the IATA code for a city name, ignoring case and surrounding spaces."""
+    if not isinstance(city, str):
+        return None
+    return _IATA_MAP.get(city.strip().lower())
+
+
+def _price_key(flight: Dict[str, Any]) -> float:
+    """Ordering key for flights: numeric price, with missing/unparseable prices last."""
+    try:
+        return float(flight.get("price"))
+    except (TypeError, ValueError):
+        return float("inf")
+
+
+# numeric fields treated as a price; providers use canonical lower/Title case
+_PRICE_KEYS = frozenset(("price", "total", "amount", "Price", "Total", "Amount"))
+
+# http(s) URLs that look like a booking/checkout link in provider JSON
+_BOOK_RE = re.compile(r"^https?://.*(?:book|purchase|pay)", re.IGNORECASE)
+
+# upper bound on how long a provider's Retry-After may hold up a search
+_MAX_RETRY_AFTER = 5.0
+_backoff = wait_exponential_jitter(multiplier=0.2, max=2.0, jitter=0.2)
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    """Retry transport failures and 429/5xx responses; other 4xx are final."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+def _wait_retry_after(retry_state) -> float:
+    """Honor a numeric Retry-After header, otherwise back off exponentially with jitter."""
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError):
+        retry_after = exc.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), _MAX_RETRY_AFTER)
+    return _backoff(retry_state)
+
+
+_provider_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=_wait_retry_after,
+    retry=retry_if_exception(_is_retryable),
+    reraise=True,
+)
 
 
 class FlightAgent:
@@ -17,21 +115,85 @@ class FlightAgent:
 
     Methods:
     - process_messages(messages): Accepts a dict-like query and returns a result dict.
+
+    All outbound HTTP goes through a shared httpx.AsyncClient so concurrent
+    requests don't block the event loop. The client and the concurrency
+    semaphore are bound to the loop they run on, so the agent keeps one of each
+    per event loop; a process-wide agent then works from any loop (e.g.
+    TestClient's, or several apps').
     """
 
-    def __init__(self, provider: Optional[str] = None, provider_api_key: Optional[str] = None) -> None:
+    # "single" returns only the cheapest flight, "top3" the three cheapest
+    MODES = ("single", "top3")
+
+    def __init__(self, provider: Optional[str] = None, provider_api_key: Optional[str] = None, mode: Literal["single", "top3"] = "top3", transport: Optional[httpx.AsyncBaseTransport] = None) -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"unknown FlightAgent mode: {mode!r}")
         self.provider = provider or "mock"
         self.provider_api_key = provider_api_key
+        self.mode = mode
+        self._top_n = 1 if mode == "single" else 3
+        # custom httpx transport (e.g. httpx.MockTransport in tests)
+        self._transport = transport
+        # per-loop state; entries go away with their (closed) loop
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+    async def cleanup(self) -> None:
+        """Close the running loop's HTTP client if it was opened."""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    def _http(self) -> httpx.AsyncClient:
+        """Return the running loop's AsyncClient, creating it on first use (or after it was closed)."""
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = self._clients[loop] = httpx.AsyncClient(timeout=10, headers=_HEADERS, transport=self._transport)
+        return client
+
+    def _limit(self) -> asyncio.Semaphore:
+        """Return the running loop's semaphore capping concurrent provider calls."""
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            # cap concurrent provider calls to stay within upstream rate limits
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(20)
+        return semaphore
+
+    @_provider_retry
+    async def _provider_get(self, url: str) -> httpx.Response:
+        """GET a provider URL, raising for non-2xx responses (retried when transient)."""
+        async with self._limit():
+            resp = await self._http().get(url)
+        resp.raise_for_status()
+        return resp
 
-    def cleanup(self) -> None:
-        """Clean up any resources (placeholder)."""
-        return None
+    @_provider_retry
+    async def _provider_stream_items(self, url: str, prefix: str, limit: int) -> List[Any]:
+        """Stream a provider JSON response and return the first `limit` items under `prefix`.
 
-    def process_messages(self, messages: Dict[str, Any]) -> Dict[str, Any]:
+        Parsing stops as soon as enough items are read, so the rest of a large
+        payload is neither downloaded nor materialized.
+        """
+        items = ijson.sendable_list()
+        parser = ijson.items_coro(items, prefix, use_float=True)
+        async with self._limit():
+            async with self._http().stream("GET", url) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.aiter_bytes():
+                    parser.send(chunk)
+                    if len(items) >= limit:
+                        return items[:limit]
+        # reached the end of the document: flush the parser
+        parser.close()
+        return items
+
+    async def process_messages(self, messages: Dict[str, Any]) -> Dict[str, Any]:
         """Process incoming messages and return a result dictionary.
 
-        This is a minimal synchronous API suitable for the scaffold. The
-        return value should be JSON-serializable.
+        The return value should be JSON-serializable.
         """
         # messages is intentionally unstructured in the scaffold; real code should
         # validate and parse the incoming A2A message schema.
@@ -43,84 +205,65 @@ class FlightAgent:
             }
 
         # call the finder which may use an external provider
-        candidate = self.find_cheapest(query)
+        candidate = await self.find_cheapest(FlightQuery.from_raw(query))
         return {
             "status": "ok",
             "query": query,
             "flights": candidate,
         }
 
-    def find_cheapest(self, query: Dict[str, Any]) -> Dict[str, Any]:
-        """Return a deterministic mock cheapest flight for a given query.
-
-        Query fields used: from, to, date, adults
-        """
-        # normalize inputs
-        origin_input = query.get("from") or query.get("origin") or None
-        dest_input = query.get("to") or query.get("destination") or query.get("flight") or None
-        date = query.get("date") or "2099-01-01"
-        adults = int(query.get("adults") or 1)
-        currency = query.get("currency") or "NGN"
-
-        # If origin not provided, try detect via ipapi.co
+    async def find_cheapest(self, query: FlightQuery) -> Dict[str, Any]:
+        """Return the cheapest flights for a normalized query (mock data without a provider)."""
+        origin_input = query.origin
+        dest_input = query.destination
+        date = query.date
+        adults = query.adults
+        currency = query.currency
+
+        # If origin not provided, try detect via ipapi.co. The lookup runs as a
+        # task so it overlaps with the destination/provider resolution below.
+        geo_task = asyncio.create_task(self._geolocate_city()) if not origin_input else None
         origin_city = None
         origin_iata = None
-        if not origin_input:
-            try:
-                r = requests.get("https://ipapi.co/json/", timeout=5)
-                ip_info = r.json()
-                origin_city = ip_info.get("city")
-            except Exception:
-                origin_city = None
-        else:
+        if origin_input:
             # if user provided an IATA code (3 letters), accept it
-            if isinstance(origin_input, str) and len(origin_input) == 3 and origin_input.isalpha():
-                origin_iata = origin_input.upper()
-            else:
+            origin_iata = _as_iata_code(origin_input)
+            if origin_iata is None:
                 origin_city = origin_input
 
-        # simple city -> IATA map (extend as needed)
-        iata_map = {
-            "Lagos": "LOS", "London": "LHR", "Abuja": "ABV",
-            "New York": "JFK", "Toronto": "YYZ", "Seoul": "ICN",
-            "Los Angeles": "LAX", "San Francisco": "SFO", "Paris": "CDG",
-        }
-
-        if origin_city and not origin_iata:
-            origin_iata = iata_map.get(origin_city, None)
-
         # Destination handling: accept IATA or map from name
         dest_iata = None
         if dest_input:
-            if isinstance(dest_input, str) and len(dest_input) == 3 and dest_input.isalpha():
-                dest_iata = dest_input.upper()
-            else:
-                dest_iata = iata_map.get(dest_input, None)
+            dest_iata = _as_iata_code(dest_input) or _city_to_iata(dest_input)
 
         # If still missing IATA codes, fall back to mock behavior
         use_provider = False
         if (self.provider and ("flightapi" in str(self.provider).lower() or str(self.provider).startswith("http"))) or (self.provider_api_key):
             use_provider = True
 
+        if geo_task is not None:
+            origin_city = await geo_task
+        if origin_city and not origin_iata:
+            origin_iata = _city_to_iata(origin_city)
+
         results: List[Dict[str, Any]] = []
 
         if use_provider and self.provider_api_key and origin_iata and dest_iata:
             # call FlightAPI.io onewaytrip endpoint
             try:
-                flights = self._call_flightapi_onewaytrip(self.provider_api_key, origin_iata, dest_iata, date, adults, currency)
+                flights = await self._call_flightapi_onewaytrip(self.provider_api_key, origin_iata, dest_iata, date, adults, currency)
                 if flights:
-                    # return top 3 structured flights
-                    for f in flights[:3]:
-                        results.append(f)
+                    # return the cheapest structured flight(s)
+                    results.extend(heapq.nsmallest(self._top_n, flights, key=_price_key))
                     return {"origin": origin_city or origin_iata, "destination": dest_input or dest_iata, "flights": results}
             except Exception:
                 # fall through to mock candidates
                 pass
 
-        # fallback mock deterministic candidates (3 entries)
+        # fallback mock deterministic candidates (cheapest first)
         seed = sum(ord(c) for c in (str(origin_iata or origin_input or "AAA") + str(dest_iata or dest_input or "BBB")))
         base = (seed % 500) + 50
-        for i in range(3):
+        for i in range(self._top_n):
             price = base + i * 20 + adults * 10
             results.append({
                 "airline": f"MockAir{i+1}",
@@ -132,9 +275,30 @@ class FlightAgent:
                 "stops": 0,
             })
 
-        return {"origin": origin_city or origin_iata or origin_input or "Unknown", "destination": dest_input or dest_iata or "Unknown", "flights": results}
+        # marked so callers don't cache placeholder prices like real fares
+        return {"origin": origin_city or origin_iata or origin_input or "Unknown", "destination": dest_input or dest_iata or "Unknown", "flights": results, "source": "mock"}
+
+    async def _geolocate_city(self) -> Optional[str]:
+        """Return the city reported by ipapi.co for this host, or None on failure.
 
-    def _search_provider(self, origin: str, dest: str, date: str, adults: int) -> Optional[Dict[str, Any]]:
+        ipapi.co/json/ resolves the egress IP of this process, so the lookup is
+        cached under the endpoint URL and shared by every request.
+        """
+        with _CACHE_LOCK:
+            city = _GEO_CACHE.get(_GEO_URL)
+        if city is not None:
+            return city
+        try:
+            r = await self._http().get(_GEO_URL, timeout=5)
+            city = orjson.loads(r.content).get("city")
+        except Exception:
+            return None
+        if city:
+            with _CACHE_LOCK:
+                _GEO_CACHE[_GEO_URL] = city
+        return city
+
+    async def _search_provider(self, origin: str, dest: str, date: str, adults: int) -> Optional[Dict[str, Any]]:
         """Best-effort call to an external provider URL.
 
         We support provider being either a short name (like 'flightapi') or a full URL.
@@ -156,39 +320,56 @@ class FlightAgent:
             }
             if base.lower() == "flightapi":
                 # try a simpler oneway endpoint
-                url = f"https://api.flightapi.io/oneway/{self.provider_api_key}/{origin}/{dest}/{date}/{adults}"
+                url = _ONEWAY_URL.format(
+                    key=urllib.parse.quote(self.provider_api_key or "", safe=""), o=urllib.parse.quote(origin, safe=""), d=urllib.parse.quote(dest, safe=""),
+                    date=urllib.parse.quote(date, safe=""), adults=adults,
+                )
             else:
                 if "?" in base:
                     url = base + "&" + urllib.parse.urlencode(params)
                 else:
                     url = base + "?" + urllib.parse.urlencode(params)
 
-            resp = requests.get(url, headers={"User-Agent": "FlightAgent/1.0"}, timeout=10)
-            data = resp.json()
+            resp = await self._provider_get(url)
+            data = orjson.loads(resp.content)
 
             candidates = self._extract_candidates_from_json(data)
             if candidates:
-                candidates.sort(key=lambda c: float(c.get("price", 1e12)))
-                return candidates[0]
+                return min(candidates, key=_price_key)
         except Exception:
             return None
 
         return None
 
-    def _call_flightapi_onewaytrip(self, api_key: str, origin: str, dest: str, date: str, adults: int, currency: str = "NGN") -> List[Dict[str, Any]]:
+    async def _call_flightapi_onewaytrip(self, api_key: str, origin: str, dest: str, date: str, adults: int, currency: str = "NGN") -> List[Dict[str, Any]]:
         """Call FlightAPI.io onewaytrip endpoint and return a list of structured flight dicts.
 
         The endpoint pattern used:
         https://api.flightapi.io/onewaytrip/{API_KEY}/{origin}/{destination}/{date}/{adults}/{currency}
         """
-        url = f"https://api.flightapi.io/onewaytrip/{api_key}/{origin}/{dest}/{date}/{adults}/{currency}"
-        resp = requests.get(url, timeout=10, headers={"User-Agent": "FlightAgent/1.0"})
-        resp.raise_for_status()
-        data = resp.json()
-
+        key = (origin.upper(), dest.upper(), date, adults, currency.upper())
+        with _CACHE_LOCK:
+            cached = _FLIGHT_CACHE.get(key)
+        if cached is _NEG:
+            # the provider failed for this search moments ago; use the mock fallback
+            return []
+        if cached is not None:
+            return cached
+
+        # path segments are user-controlled, so escape '/', '+', spaces etc.
+        url = _ONEWAYTRIP_URL.format(
+            key=urllib.parse.quote(api_key, safe=""), o=urllib.parse.quote(origin, safe=""), d=urllib.parse.quote(dest, safe=""),
+            date=urllib.parse.quote(date, safe=""), adults=adults, cur=urllib.parse.quote(currency, safe=""),
+        )
         results: List[Dict[str, Any]] = []
         # Expected structure: data.data -> list of flights, each with legs
-        for flight in data.get("data", [])[:10]:
+        try:
+            flights = await self._provider_stream_items(url, "data.item", 10)
+        except Exception:
+            with _CACHE_LOCK:
+                _FLIGHT_CACHE[key] = _NEG
+            raise
+        for flight in flights:
             try:
                 leg = flight.get("legs", [])[0]
                 carriers = leg.get("carriers", {})
@@ -209,36 +390,36 @@ class FlightAgent:
                 # skip malformed entries
                 continue
 
+        with _CACHE_LOCK:
+            # a 200 without flights (e.g. {"message": "quota exceeded"}) is a
+            # failure too; don't pin it for the date-derived TTL
+            _FLIGHT_CACHE[key] = results if results else _NEG
         return results
 
     def _extract_candidates_from_json(self, data: Any) -> List[Dict[str, Any]]:
-        """Recursively scan JSON for price-like fields and return candidate dicts.
+        """Scan JSON for price-like fields and return candidate dicts.
 
         This is a heuristic parser: it looks for dicts containing numeric fields
         named 'price', 'total', 'amount' or similar, and tries to find a booking
-        link in nearby string fields.
+        link in nearby string fields. Nodes are visited with an explicit stack so
+        deeply nested payloads can't hit the recursion limit.
         """
         candidates: List[Dict[str, Any]] = []
-
-        def walk(obj) -> List[Tuple[Optional[float], Optional[str]]]:
-            found: List[Tuple[Optional[float], Optional[str]]] = []
+        stack = deque([data])
+        while stack:
+            obj = stack.pop()
             if isinstance(obj, dict):
                 price = None
                 link = None
                 for k, v in obj.items():
-                    key = k.lower()
-                    if key in ("price", "total", "amount") and isinstance(v, (int, float)):
+                    if k in _PRICE_KEYS and isinstance(v, (int, float)):
                         price = float(v)
-                    if isinstance(v, str) and v.startswith("http") and ("book" in v or "purchase" in v or "pay" in v or "/book" in v):
+                    if isinstance(v, str) and _BOOK_RE.match(v):
                         link = v
-                    # recurse
-                    found.extend(walk(v))
                 if price is not None:
                     candidates.append({"price": price, "booking_link": link or ""})
+                stack.extend(obj.values())
             elif isinstance(obj, list):
-                for item in obj:
-                    found.extend(walk(item))
-            return found
+                stack.extend(obj)
 
-        walk(data)
         return candidates
@@ -0,0 +1,10 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from main import create_app
+
+
+@pytest.fixture(scope="session")
+def client():
+    """One app + TestClient for the whole test session."""
+    return TestClient(create_app())
@@ -4,144 +4,352 @@ This module is safe to import for quick checks (it does not import FastAPI at to
 Call create_app() to get a FastAPI app object when FastAPI is installed.
 """
 
+import logging
+import threading
+
 __version__ = "0.1.0"
 
+_logger = logging.getLogger(__name__)
 
-def create_app():
-    """Create and return a FastAPI app instance.
+# JSON-RPC method -> how to pull the message object(s) out of params
+_MSG_EXTRACTORS = {
+    "message/send": lambda params: params.get("message"),
+    "execute": lambda params: params.get("messages"),
+}
 
-    This function imports FastAPI only when called so importing this module
-    doesn't require FastAPI to be installed (useful for quick import checks).
+# pre-serialized JSON-RPC envelopes; only the id (and result/error data) vary
+_RPC_RESULT_PREFIX = b'{"jsonrpc":"2.0","id":'
+_AGENT_UNAVAILABLE_TEMPLATE = b'{"jsonrpc":"2.0","id":%s,"error":{"code":-32000,"message":"agent not available"}}'
+_INVALID_PARAMS_TEMPLATE = b'{"jsonrpc":"2.0","id":%s,"error":{"code":-32602,"message":"Invalid params","data":%s}}'
+_INTERNAL_ERROR_TEMPLATE = b'{"jsonrpc":"2.0","id":%s,"error":{"code":-32603,"message":"Internal error","data":%s}}'
+
+# most searches one batched request may fan out to the provider
+_MAX_BATCH_QUERIES = 20
+
+# a data part holding any of these keys is taken as the search query
+_QUERY_KEYS = frozenset(("from", "input", "to"))
+# flat search fields accepted directly on params (both 'to' and 'destination'
+# so callers using either key are supported)
+_FLAT_KEYS_SET = frozenset(("input", "from", "to", "destination", "date", "adults", "flight"))
+
+
+def _extract_query_from_rpc(body):
+    """Unwrap a JSON-RPC 2.0 body into (rpc_id, query, is_rpc).
+
+    The query is the first message data part that looks like a search, else
+    params.query, else the flat search fields on params, else {}. Bodies that
+    aren't JSON-RPC give (None, None, False). Never raises.
     """
-    try:
-        from fastapi import FastAPI, Request
-        from fastapi.staticfiles import StaticFiles
-        from fastapi.responses import JSONResponse
-    except Exception as e:
-        raise RuntimeError("FastAPI is required to create the web app: " + str(e))
+    if not (isinstance(body, dict) and body.get("jsonrpc") == "2.0"):
+        return None, None, False
+
+    params = body.get("params")
+    if not isinstance(params, dict):
+        params = {}
+    # default: try to find a message.parts[].data or a params.message
+    extractor = _MSG_EXTRACTORS.get(body.get("method"))
+    msg_obj = extractor(params) if extractor else None
+
+    # normalize parts list
+    parts = []
+    if isinstance(msg_obj, dict) and isinstance(msg_obj.get("parts"), list):
+        parts = msg_obj["parts"]
+    elif isinstance(msg_obj, list):
+        # 'messages' could be a list of messages
+        for m in msg_obj:
+            if isinstance(m, dict) and isinstance(m.get("parts"), list):
+                parts.extend(m["parts"])
+
+    # the first data part that already contains a structured query
+    data_parts = (
+        p["data"] for p in parts
+        if isinstance(p, dict) and p.get("kind") == "data" and isinstance(p.get("data"), dict)
+    )
+    query = next((d for d in data_parts if not _QUERY_KEYS.isdisjoint(d)), None)
+
+    # fallback: if params contains direct fields
+    if query is None:
+        if "query" in params and isinstance(params.get("query"), dict):
+            query = params.get("query")
+        else:
+            # accept flat fields like input, from, to; the C-level set
+            # intersection only visits the keys actually present
+            keys = params.keys() & _FLAT_KEYS_SET
+            if keys:
+                query = {k: params[k] for k in keys}
+
+    # if still no query, set to empty dict
+    if query is None:
+        query = {}
+    return body.get("id"), query, True
+
 
-    app = FastAPI(title="Flight Agent")
+def _extract_query_plain(body):
+    """Return the query of a non-RPC body: {"query": {...}} or the raw body itself."""
+    if isinstance(body, dict) and "query" in body:
+        return body["query"]
+    return body
 
-    # instantiate a single agent for the app lifecycle
+
+def _extract_batch(body, is_rpc):
+    """Return the batched query list (params.queries for JSON-RPC, else queries), or None."""
+    container = body.get("params") if is_rpc else body
+    queries = container.get("queries") if isinstance(container, dict) else None
+    return queries if isinstance(queries, list) else None
+
+
+def _is_live_search(result):
+    """True for a successful search answered by the provider rather than the mock fallback."""
+    if not isinstance(result, dict) or result.get("status") != "ok":
+        return False
+    flights = result.get("flights")
+    return isinstance(flights, dict) and flights.get("source") != "mock"
+
+
+def _result_ttu(key, result, now):
+    """Keep live searches for 60s; errors, empty results and mock fallbacks only for 10s."""
+    live = _is_live_search(result) and result["flights"].get("flights")
+    return now + (60 if live else 10)
+
+
+def _batch_error(queries):
+    """Return why a batched query list is rejected (too long, non-object items), or None."""
+    if len(queries) > _MAX_BATCH_QUERIES:
+        return f"at most {_MAX_BATCH_QUERIES} queries per batch"
+    if not all(isinstance(q, dict) for q in queries):
+        return "each batched query must be an object"
+    return None
+
+
+# process-wide FlightAgent shared by every create_app() call; _UNBUILT until
+# the first request needs it (None if it couldn't be built)
+_UNBUILT = object()
+_FLIGHT_AGENT_SINGLETON = _UNBUILT
+_FLIGHT_AGENT_LOCK = threading.Lock()
+
+
+def _build_flight_agent():
+    """Read the FLIGHT_PROVIDER* and FLIGHT_AGENT_MODE env vars and construct a FlightAgent, or None on failure."""
     try:
         import os
         from agents import FlightAgent
         provider = os.getenv("FLIGHT_PROVIDER", "mock")
         provider_url = os.getenv("FLIGHT_PROVIDER_URL", "")
         api_key = os.getenv("FLIGHT_PROVIDER_API_KEY", "")
+        mode = os.getenv("FLIGHT_AGENT_MODE", "top3")
+        if mode not in FlightAgent.MODES:
+            # a config typo shouldn't take the agent down; say so and carry on
+            _logger.warning("Unknown FLIGHT_AGENT_MODE %r; using 'top3'", mode)
+            mode = "top3"
         # prefer an explicit provider URL if given
         agent_provider = provider_url if provider_url else provider
-        flight_agent = FlightAgent(provider=agent_provider, provider_api_key=api_key)
+        return FlightAgent(provider=agent_provider, provider_api_key=api_key, mode=mode)
     except Exception:
         # if agents package isn't present the endpoint will return an error
-        flight_agent = None
+        _logger.exception("Could not build the FlightAgent; /a2a/flight will report it unavailable")
+        return None
 
-    # Mount a simple static UI if available
+
+def _get_flight_agent():
+    """Return the process-wide FlightAgent, building it on first use.
+
+    The agents package (and its HTTP/caching dependencies) is only imported
+    then, so create_app() and serverless cold starts don't pay for it, and
+    repeated create_app() calls (e.g. one per test module) share one agent.
+    The double-checked lock guarantees a single construction across threads.
+    """
+    global _FLIGHT_AGENT_SINGLETON
+    if _FLIGHT_AGENT_SINGLETON is _UNBUILT:
+        with _FLIGHT_AGENT_LOCK:
+            if _FLIGHT_AGENT_SINGLETON is _UNBUILT:
+                _FLIGHT_AGENT_SINGLETON = _build_flight_agent()
+    return _FLIGHT_AGENT_SINGLETON
+
+
+def create_app():
+    """Create and return a FastAPI app instance.
+
+    This function imports FastAPI only when called so importing this module
+    doesn't require FastAPI to be installed (useful for quick import checks).
+    """
     try:
-        app.mount("/ui", StaticFiles(directory="static", html=True), name="static")
-    except Exception:
-        # ignore if static folder doesn't exist yet
-        pass
+        import asyncio
+        import hashlib
+        import inspect
+        import os
+        from contextlib import asynccontextmanager
+        from fastapi import FastAPI, Request
+        from fastapi.concurrency import run_in_threadpool
+        from fastapi.staticfiles import StaticFiles
+        from fastapi.responses import JSONResponse, Response
+        import orjson
+        from cachetools import TLRUCache
+        from models import derive_ttl
+    except Exception as e:
+        raise RuntimeError("FastAPI is required to create the web app: " + str(e))
+
+    class ORJSONResponse(JSONResponse):
+        """JSONResponse serialized with orjson (FastAPI's own ORJSONResponse is deprecated)."""
+
+        def render(self, content) -> bytes:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        # close the agent's HTTP client for this loop, but only if a request built it
+        flight_agent = _FLIGHT_AGENT_SINGLETON
+        if flight_agent is not _UNBUILT and flight_agent is not None:
+            await flight_agent.cleanup()
+
+    app = FastAPI(title="Flight Agent", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+    # Mount the scaffold UI unless FLIGHT_SERVE_UI=0 (production deployments
+    # skip the mount and its per-request stat calls) or static/ isn't there
+    if os.getenv("FLIGHT_SERVE_UI", "1") == "1" and os.path.isdir("static"):
+        app.mount("/ui", StaticFiles(directory="static", html=True, check_dir=False), name="static")
+
+    async def invoke_agent(flight_agent, query):
+        """Await a coroutine process_messages; run a synchronous one in the threadpool.
+
+        FlightAgent is async, but a blocking drop-in agent must not stall the
+        event loop for every other request.
+        """
+        if inspect.iscoroutinefunction(flight_agent.process_messages):
+            return await flight_agent.process_messages({"query": query})
+        return await run_in_threadpool(flight_agent.process_messages, {"query": query})
+
+    # recent agent results and searches currently running, both keyed by the
+    # canonical query bytes; identical concurrent requests await one shared
+    # search task instead of re-running it
+    recent_results = TLRUCache(maxsize=1024, ttu=_result_ttu)
+    inflight = {}
+
+    async def search_and_cache(key, flight_agent, query):
+        """Run one agent search and remember its result; always leaves `inflight`."""
+        try:
+            result = await invoke_agent(flight_agent, query)
+        finally:
+            del inflight[key]
+        recent_results[key] = result
+        return result
+
+    async def call_agent(flight_agent, query):
+        """Run the agent for `query`, reusing a recent result or an identical in-flight search."""
+        key = orjson.dumps(query, option=orjson.OPT_SORT_KEYS)
+        cached = recent_results.get(key)
+        if cached is not None:
+            return cached
+        task = inflight.get(key)
+        if task is None:
+            # no await between the lookup above and this insert, so the event
+            # loop can't interleave another request here and no lock is needed
+            task = inflight[key] = asyncio.create_task(search_and_cache(key, flight_agent, query))
+        # the search runs in its own task and every caller, the first one
+        # included, awaits it through a shield: a cancelled caller (client
+        # disconnect, timeout) doesn't cancel the search the others wait on
+        return await asyncio.shield(task)
+
+    async def run_agent(flight_agent, query, queries=None):
+        """Run the agent on `query`, or concurrently on each item of `queries` when given.
+
+        Batched results keep request order and are returned as {"results": [...]}.
+        """
+        if isinstance(queries, list):
+            results = await asyncio.gather(*(call_agent(flight_agent, q) for q in queries))
+            return {"results": list(results)}
+        return await call_agent(flight_agent, query)
 
-    @app.post("/a2a/flight")
+    def search_response(request, result, rpc_id=None, is_rpc=False):
+        """Return a 200 for a search `result`, wrapped in a JSON-RPC envelope when `is_rpc`.
+
+        The result is serialized once and the envelope is spliced around those
+        bytes. Only live provider searches get ETag/Cache-Control (errors and
+        mock fallbacks don't); the ETag hashes the body actually sent, so RPC
+        replies with different ids never share one, and max-age follows the
+        agent's flight cache TTL (the shortest one for a batch). Answers 304
+        when the caller's If-None-Match already matches.
+        """
+        result_bytes = orjson.dumps(result, option=orjson.OPT_NON_STR_KEYS)
+        if is_rpc:
+            body = _RPC_RESULT_PREFIX + orjson.dumps(rpc_id) + b',"result":' + result_bytes + b"}"
+        else:
+            body = result_bytes
+
+        items = None
+        if isinstance(result, dict):
+            items = result.get("results") if "results" in result else [result]
+        if not items or not all(_is_live_search(r) for r in items):
+            return Response(content=body, media_type="application/json")
+
+        max_age = min(derive_ttl(r["query"].get("date") if isinstance(r.get("query"), dict) else None) for r in items)
+        digest = hashlib.blake2b(body, digest_size=8).hexdigest()
+        headers = {"ETag": f'"{digest}"', "Cache-Control": f"public, max-age={max_age}"}
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    @app.exception_handler(Exception)
+    async def _unhandled(request, exc):
+        # only reached on unexpected errors, so the happy path carries no try block
+        return ORJSONResponse(status_code=500, content={"error": "unexpected server error", "details": str(exc)})
+
+    # every branch returns a ready Response, which FastAPI passes through as-is
+    # (no jsonable_encoder / response-model validation)
+    @app.post("/a2a/flight", response_class=ORJSONResponse, response_model=None)
     async def a2a_flight(request: Request):
         """Simple HTTP endpoint that accepts a JSON payload and returns the cheapest flight.
 
         Expected request shape (from the scaffold UI):
         { "query": { "from":..., "to":..., "date":..., "adults": N } }
+
+        Several searches (up to _MAX_BATCH_QUERIES query objects) can be
+        batched as { "queries": [ {...}, ... ] } (or params.queries for
+        JSON-RPC); they run concurrently.
         """
+        # orjson takes the raw bytes directly, skipping Starlette's decode + json.loads
+        raw = await request.body()
         try:
-            body = await request.json()
-        except Exception:
-            return JSONResponse(status_code=400, content={"error": "invalid json"})
-        # If the caller uses JSON-RPC (A2A) format, unwrap it and return JSON-RPC
+            body = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            return ORJSONResponse(status_code=400, content={"error": "invalid json"})
+        flight_agent = _get_flight_agent()
+        # (1) detect the shape and (2) pull out the query/queries
+        rpc_id, query, is_rpc = _extract_query_from_rpc(body)
+        if not is_rpc:
+            query = _extract_query_plain(body)
+        queries = _extract_batch(body, is_rpc)
+        message = _batch_error(queries) if queries is not None else None
+        if message is not None:
+            if is_rpc:
+                payload = _INVALID_PARAMS_TEMPLATE % (orjson.dumps(rpc_id), orjson.dumps(message))
+                return Response(content=payload, media_type="application/json", status_code=400)
+            return ORJSONResponse(status_code=400, content={"error": message})
+
+        if flight_agent is None:
+            if is_rpc:
+                payload = _AGENT_UNAVAILABLE_TEMPLATE % orjson.dumps(rpc_id)
+                return Response(content=payload, media_type="application/json", status_code=500)
+            return ORJSONResponse(status_code=500, content={"error": "agent not available"})
+
+        # (3) run the agent
         try:
-            # JSON-RPC 2.0 wrapper
-            if isinstance(body, dict) and body.get("jsonrpc") == "2.0":
-                rpc_id = body.get("id")
-                method = body.get("method")
-
-                # extract messages depending on method
-                params = body.get("params") or {}
-                # default: try to find a message.parts[].data or a params.message
-                msg_obj = None
-                if method == "message/send":
-                    msg_obj = params.get("message")
-                elif method == "execute":
-                    msg_obj = params.get("messages")
-
-                # normalize parts list
-                parts = []
-                if isinstance(msg_obj, dict) and "parts" in msg_obj:
-                    parts = msg_obj.get("parts") or []
-                elif isinstance(msg_obj, list):
-                    # 'messages' could be a list of messages
-                    for m in msg_obj:
-                        if isinstance(m, dict) and "parts" in m:
-                            parts.extend(m.get("parts") or [])
-
-                # find the first data part and build a query
-                query = None
-                for p in parts:
-                    if not isinstance(p, dict):
-                        continue
-                    if p.get("kind") == "data":
-                        data = p.get("data") or {}
-                        # if data already contains a structured query, use it
-                        if isinstance(data, dict) and ("from" in data or "input" in data or "to" in data):
-                            query = data
-                            break
-
-                # fallback: if params contains direct fields
-                if query is None and isinstance(params, dict):
-                    if "query" in params and isinstance(params.get("query"), dict):
-                        query = params.get("query")
-                    else:
-                        # accept flat fields like input, from, to
-                        # accept both 'to' and 'destination' so callers using that key are supported
-                        flat_keys = ("input", "from", "to", "destination", "date", "adults", "flight")
-                        q = {k: params.get(k) for k in flat_keys if k in params}
-                        if q:
-                            query = q
-
-                # if still no query, set to empty dict
-                if query is None:
-                    query = {}
-
-                if flight_agent is None:
-                    resp = {"jsonrpc": "2.0", "id": rpc_id, "error": {"code": -32000, "message": "agent not available"}}
-                    return JSONResponse(status_code=500, content=resp)
-
-                # call the agent with a consistent shape
-                try:
-                    result = flight_agent.process_messages({"query": query})
-                    rpc_resp = {"jsonrpc": "2.0", "id": rpc_id, "result": result}
-                    return JSONResponse(status_code=200, content=rpc_resp)
-                except Exception as e:
-                    rpc_err = {"jsonrpc": "2.0", "id": rpc_id, "error": {"code": -32603, "message": "Internal error", "data": str(e)}}
-                    return JSONResponse(status_code=500, content=rpc_err)
-
-            # support either {query: {...}} or a raw dict (non-RPC callers)
-            if isinstance(body, dict) and "query" in body:
-                query = body["query"]
-            else:
-                query = body
-
-            if flight_agent is None:
-                return JSONResponse(status_code=500, content={"error": "agent not available"})
-
-            try:
-                # agent.process_messages expects a dict with a 'query' key in the scaffold
-                result = flight_agent.process_messages({"query": query})
-                return JSONResponse(status_code=200, content=result)
-            except Exception as e:
-                return JSONResponse(status_code=500, content={"error": str(e)})
+            result = await run_agent(flight_agent, query, queries)
         except Exception as e:
-            return JSONResponse(status_code=500, content={"error": "unexpected server error", "details": str(e)})
+            if is_rpc:
+                payload = _INTERNAL_ERROR_TEMPLATE % (orjson.dumps(rpc_id), orjson.dumps(str(e)))
+                return Response(content=payload, media_type="application/json", status_code=500)
+            return ORJSONResponse(status_code=500, content={"error": str(e)})
+
+        # (4) wrap the result for the caller's shape
+        return search_response(request, result, rpc_id, is_rpc)
 
-    @app.get("/health")
+    # the health payload never changes, so serialize it once per app
+    health_body = orjson.dumps({"status": "healthy", "version": __version__})
+
+    @app.get("/health", response_class=Response, response_model=None)
     def _health():
-        return {"status": "healthy", "version": __version__}
+        return Response(content=health_body, media_type="application/json")
 
     return app
 
@@ -149,37 +357,66 @@ def create_app():
 if __name__ == "__main__":
     # runtime run if uvicorn is available
     try:
+        import os
+        import sys
         import uvicorn
-        uvicorn.run("main:create_app()", host="127.0.0.1", port=8000, reload=False)
+        uvicorn.run(
+            "main:create_app",
+            factory=True,
+            host="127.0.0.1",
+            port=8000,
+            reload=False,
+            # uvloop and httptools ship with uvicorn[standard]; uvloop has no Windows build
+            loop="asyncio" if sys.platform == "win32" else "uvloop",
+            http="httptools",
+            workers=min(4, os.cpu_count() or 1),
+            # keep idle client connections open longer so bursty agents reuse them
+            timeout_keep_alive=30,
+            # skip the per-request access log line
+            access_log=False,
+        )
     except Exception as e:
-        print("Run with: uvicorn main:create_app --reload")
+        print("Run with: uvicorn main:create_app --factory --reload")
         print("Error starting uvicorn:", e)
 
 
-# Many deployment platforms (including Vercel) expect a top-level ASGI `app`
-# variable. Provide one by trying to instantiate the FastAPI app. If FastAPI
-# (or other dependencies) are not available in the environment, fall back to a
-# minimal ASGI app that returns 503 so the import doesn't fail.
-try:
-    app = create_app()
-except Exception:
-    async def app(scope, receive, send):
-        # minimal ASGI fallback returning 503 for HTTP requests
-        if scope.get("type") == "http":
-            body = b"FastAPI not available; please install dependencies or run with uvicorn create_app()."
-            await send({"type": "http.response.start", "status": 503, "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
-            await send({"type": "http.response.body", "body": body})
-        else:
-            # noop for non-http scopes
-            return
-
-# Export `handler` as an alias to the ASGI app so both `app` and `handler` are available
-# (some serverless platforms look for `handler` specifically).
-try:
-    # If Mangum is available, wrap the ASGI app into a Lambda-style handler which
-    # works well on many serverless platforms (including Vercel's Python runtime).
-    from mangum import Mangum
-    handler = Mangum(app)
-except Exception:
-    # fall back to exporting the ASGI app directly
+async def _unavailable_app(scope, receive, send):
+    """Minimal ASGI fallback returning 503 when the FastAPI app can't be built."""
+    if scope.get("type") == "http":
+        body = b"FastAPI not available; please install dependencies or run with uvicorn create_app()."
+        await send({"type": "http.response.start", "status": 503, "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+        await send({"type": "http.response.body", "body": body})
+    else:
+        # noop for non-http scopes
+        return
+
+
+def __getattr__(name):
+    """Build the module-level `app` and `handler` on first access (PEP 562).
+
+    Many deployment platforms (including Vercel) expect a top-level ASGI `app`
+    variable, and some serverless platforms look for `handler` specifically;
+    Mangum only wraps it when running on AWS Lambda or Vercel.
+    Creating them lazily keeps `import main` cheap; once built they are stored
+    as real module globals so this hook only runs once. If FastAPI (or other
+    dependencies) are missing, `app` is a minimal ASGI app that returns 503.
+    """
+    if name not in ("app", "handler"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    try:
+        app = create_app()
+    except Exception:
+        app = _unavailable_app
+    import os
     handler = app
+    if os.environ.get("AWS_LAMBDA_FUNCTION_NAME") or os.environ.get("VERCEL"):
+        try:
+            # On Lambda/Vercel wrap the ASGI app into a Lambda-style handler. Skip
+            # Mangum's lifespan machinery, which only adds cold-start latency there.
+            from mangum import Mangum
+            handler = Mangum(app, lifespan="off")
+        except ImportError:
+            # fall back to exporting the ASGI app directly
+            pass
+    globals().update(app=app, handler=handler)
+    return globals()[name]
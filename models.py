@@ -1,57 +1,95 @@
-"""Minimal models used by the scaffold.# models/a2a.py
-
-from pydantic import BaseModel, Field
-
-This file intentionally avoids third-party dependencies so `import main` worksfrom typing import Literal, Optional, List, Dict, Any
-
-without installing packages.from datetime import datetime
-
-"""from uuid import uuid4
+"""Models used by the scaffold.
 
+The dataclasses at the top are plain Python. The A2A JSON-RPC schemas below
+them use pydantic, which is installed alongside FastAPI.
+"""
 from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Any, Dict, List, Literal, Optional
+from uuid import uuid4
 
-from typing import Any, Dict, List, Optionalclass MessagePart(BaseModel):
-
-    kind: Literal["text", "data", "file"]
+from pydantic import BaseModel, Field
 
-    text: Optional[str] = None
 
-@dataclass    data: Optional[Dict[str, Any]] = None
+def derive_ttl(date_str: Optional[str]) -> int:
+    """Return how long (seconds) a fare search for `date_str` may be cached.
+
+    Prices close to departure move fast while far-future fares are stable, so
+    the TTL grows with the number of days until the flight.
+    """
+    try:
+        days = (datetime.fromisoformat(date_str).date() - date.today()).days
+    except (TypeError, ValueError):
+        return 600
+    if days <= 1:
+        return 60
+    if days <= 7:
+        return 600
+    if days <= 30:
+        return 3600
+    return 21600
+
+
+@dataclass(slots=True, frozen=True)
+class FlightQuery:
+    """A flight search normalized once from the loosely-shaped request dict."""
+
+    origin: Optional[str]
+    destination: Optional[str]
+    date: str = "2099-01-01"
+    adults: int = 1
+    currency: str = "NGN"
+
+    @classmethod
+    def from_raw(cls, q: Dict[str, Any]) -> "FlightQuery":
+        """Build a FlightQuery from request fields (from/origin, to/destination/flight, ...).
+
+        Missing fields fall back to the scaffold defaults; `adults` is cast to int.
+        """
+        return cls(
+            origin=q.get("from") or q.get("origin") or None,
+            destination=q.get("to") or q.get("destination") or q.get("flight") or None,
+            date=q.get("date") or "2099-01-01",
+            adults=int(q.get("adults") or 1),
+            currency=q.get("currency") or "NGN",
+        )
+
+
+@dataclass(slots=True, frozen=True)
+class FlightCandidate:
+    price: float
+    currency: str
+    airline: str
+    booking_link: str
 
-class FlightQuery:    file_url: Optional[str] = None
 
-    origin: str
+# helper typed alias
+JSONDict = Dict[str, Any]
 
-    destination: strclass A2AMessage(BaseModel):
 
-    date: str    kind: Literal["message"] = "message"
+# A2A JSON-RPC schemas
 
-    adults: int = 1    role: Literal["user", "agent", "system"]
+class MessagePart(BaseModel):
+    kind: Literal["text", "data", "file"]
+    text: Optional[str] = None
+    data: Optional[Dict[str, Any]] = None
+    file_url: Optional[str] = None
 
+class A2AMessage(BaseModel):
+    kind: Literal["message"] = "message"
+    role: Literal["user", "agent", "system"]
     parts: List[MessagePart]
-
     messageId: str = Field(default_factory=lambda: str(uuid4()))
+    taskId: Optional[str] = None
+    metadata: Optional[Dict[str, Any]] = None
 
-@dataclass    taskId: Optional[str] = None
-
-class FlightCandidate:    metadata: Optional[Dict[str, Any]] = None
-
-    price: float
-
-    currency: strclass PushNotificationConfig(BaseModel):
-
-    airline: str    url: str
-
-    booking_link: str    token: Optional[str] = None
-
+class PushNotificationConfig(BaseModel):
+    url: str
+    token: Optional[str] = None
     authentication: Optional[Dict[str, Any]] = None
 
-
-
-# helper typed aliasclass MessageConfiguration(BaseModel):
-
-JSONDict = Dict[str, Any]    blocking: bool = True
-
+class MessageConfiguration(BaseModel):
+    blocking: bool = True
     acceptedOutputModes: List[str] = ["text/plain", "image/png", "image/svg+xml"]
     pushNotificationConfig: Optional[PushNotificationConfig] = None
 
@@ -1,13 +1,40 @@
+import asyncio
+from datetime import date, timedelta
+
+import httpx
 from fastapi.testclient import TestClient
+import main
 from main import create_app
 from agents.a2a_client import call_flight_search, send_message_parts
+from agents import FlightAgent
+from agents.flight_agent import _FLIGHT_CACHE, _NEG
+from models import derive_ttl
 import os
 
-app = create_app()
-client = TestClient(app)
+
+class StubAgent:
+    """Stands in for FlightAgent: returns a fixed live search and counts calls."""
+
+    def __init__(self, source=None, delay=0.01):
+        self.calls = 0
+        self.source = source
+        self.delay = delay
+
+    async def process_messages(self, messages):
+        self.calls += 1
+        # yield so concurrent identical searches overlap with this one
+        await asyncio.sleep(self.delay)
+        flights = {"origin": "LOS", "destination": "LHR", "flights": [{"airline": "StubAir", "price": 100}]}
+        if self.source:
+            flights["source"] = self.source
+        return {"status": "ok", "query": messages["query"], "flights": flights}
 
 
-def test_jsonrpc_direct():
+def rpc_search(rpc_id, query):
+    return {"jsonrpc": "2.0", "id": rpc_id, "method": "flight/search", "params": {"query": query}}
+
+
+def test_jsonrpc_direct(client):
     """Simulate an AI agent calling the JSON-RPC flight/search method."""
     # We can call the local TestClient directly by posting to the ASGI app
     url = '/a2a/flight'
@@ -28,7 +55,7 @@ def test_jsonrpc_direct():
     print(resp.json())
 
 
-def test_message_parts_style():
+def test_message_parts_style(client):
     """Simulate an AI agent sending messages.parts where one part contains data."""
     url = '/a2a/flight'
     payload = {
@@ -49,6 +76,257 @@ def test_message_parts_style():
     print(resp.json())
 
 
+def test_batched_queries(client):
+    """Simulate an AI agent batching several searches into one JSON-RPC call."""
+    url = '/a2a/flight'
+    payload = {
+        "jsonrpc": "2.0",
+        "id": "batch-1",
+        "method": "flight/search",
+        "params": {
+            "queries": [
+                {"from": "LOS", "to": "LHR", "date": "2025-11-10", "adults": 1},
+                {"from": "LOS", "to": "CDG", "date": "2025-11-10", "adults": 2},
+            ]
+        }
+    }
+    resp = client.post(url, json=payload)
+    print('batched status:', resp.status_code)
+    results = resp.json()["result"]["results"]
+    assert [r["query"]["to"] for r in results] == ["LHR", "CDG"]
+
+
+def test_oversized_batch_rejected(client):
+    """Batches beyond the cap are refused before any search runs."""
+    queries = [{"to": "LHR"}] * (main._MAX_BATCH_QUERIES + 1)
+    resp = client.post('/a2a/flight', json={"jsonrpc": "2.0", "id": "big", "method": "flight/search", "params": {"queries": queries}})
+    assert resp.status_code == 400
+    assert resp.json()["error"]["code"] == -32602
+    resp = client.post('/a2a/flight', json={"queries": queries})
+    assert resp.status_code == 400
+
+
+def test_non_object_batch_item_rejected(client):
+    """A batch with a non-object item is a 400, not a 500 from inside the agent."""
+    queries = [{"to": "LHR"}, 5]
+    resp = client.post('/a2a/flight', json={"jsonrpc": "2.0", "id": "bad", "method": "flight/search", "params": {"queries": queries}})
+    assert resp.status_code == 400
+    assert resp.json()["error"]["code"] == -32602
+    resp = client.post('/a2a/flight', json={"queries": queries})
+    assert resp.status_code == 400
+    assert resp.json() == {"error": "each batched query must be an object"}
+
+
+def test_etag_differs_per_rpc_id(monkeypatch):
+    """A 304 must not let a cached envelope with another id stand in for this one."""
+    monkeypatch.setattr(main, "_FLIGHT_AGENT_SINGLETON", StubAgent())
+    client = TestClient(create_app())
+    query = {"from": "LOS", "to": "LHR", "date": "2099-01-01"}
+    etag_a = client.post('/a2a/flight', json=rpc_search("a", query)).headers["etag"]
+    etag_b = client.post('/a2a/flight', json=rpc_search("b", query)).headers["etag"]
+    assert etag_a != etag_b
+
+    resp = client.post('/a2a/flight', json=rpc_search("b", query), headers={"If-None-Match": etag_a})
+    assert resp.status_code == 200
+    assert resp.json()["id"] == "b"
+    resp = client.post('/a2a/flight', json=rpc_search("b", query), headers={"If-None-Match": etag_b})
+    assert resp.status_code == 304
+
+
+def test_mock_fallback_not_http_cached(monkeypatch):
+    """Mock fallback flights carry no ETag/Cache-Control."""
+    monkeypatch.setattr(main, "_FLIGHT_AGENT_SINGLETON", StubAgent(source="mock"))
+    resp = TestClient(create_app()).post('/a2a/flight', json=rpc_search("m", {"to": "LHR"}))
+    assert resp.status_code == 200
+    assert "etag" not in resp.headers and "cache-control" not in resp.headers
+
+
+def test_identical_concurrent_searches_share_one_call(monkeypatch):
+    """Duplicate queries gathered in one batch run the agent once, in-flight and then cached."""
+    agent = StubAgent()
+    monkeypatch.setattr(main, "_FLIGHT_AGENT_SINGLETON", agent)
+    client = TestClient(create_app())
+    query = {"from": "LOS", "to": "LHR", "date": "2099-01-01"}
+    resp = client.post('/a2a/flight', json={"queries": [query, dict(reversed(query.items())), query]})
+    assert len(resp.json()["results"]) == 3
+    assert agent.calls == 1
+    client.post('/a2a/flight', json={"query": query})
+    assert agent.calls == 1
+
+
+def test_cancelled_leader_does_not_fail_followers(monkeypatch):
+    """A disconnecting first caller must not cancel the search an identical request awaits."""
+    agent = StubAgent(delay=0.1)
+    monkeypatch.setattr(main, "_FLIGHT_AGENT_SINGLETON", agent)
+    app = create_app()
+    query = {"from": "LOS", "to": "CDG", "date": "2099-01-01"}
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            leader = asyncio.create_task(http.post('/a2a/flight', json={"query": query}))
+            await asyncio.sleep(0.02)
+            follower = asyncio.create_task(http.post('/a2a/flight', json={"query": query}))
+            await asyncio.sleep(0.02)
+            leader.cancel()
+            return await follower
+
+    resp = asyncio.run(run())
+    assert resp.status_code == 200
+    assert resp.json()["status"] == "ok"
+    assert agent.calls == 1
+
+
+def test_result_cache_ttl():
+    """Live searches are cached for 60s; mock fallbacks, empty results and errors for 10s."""
+    live = {"status": "ok", "flights": {"flights": [{"price": 100}]}}
+    mock = {"status": "ok", "flights": {"flights": [{"price": 100}], "source": "mock"}}
+    empty = {"status": "ok", "flights": {"flights": []}}
+    error = {"status": "error", "message": "no query provided"}
+    assert main._result_ttu(b"k", live, 0) == 60
+    assert [main._result_ttu(b"k", r, 0) for r in (mock, empty, error)] == [10, 10, 10]
+
+
+def search_with_transport(handler, query, mode="top3"):
+    """Run one FlightAgent search against an httpx.MockTransport; return (result, provider calls)."""
+    calls = []
+
+    def count(request):
+        calls.append(request.url)
+        return handler(request)
+
+    async def run():
+        agent = FlightAgent(provider="flightapi", provider_api_key="k", mode=mode, transport=httpx.MockTransport(count))
+        try:
+            return await agent.process_messages({"query": query})
+        finally:
+            await agent.cleanup()
+
+    return asyncio.run(run()), len(calls)
+
+
+def provider_flight(airline, price):
+    """One FlightAPI.io onewaytrip item in the shape the agent parses."""
+    return {
+        "legs": [{
+            "carriers": {"marketing": [{"name": airline}]},
+            "duration": "6h",
+            "departure": {"time": "2099-06-01T08:00:00"},
+            "arrival": {"time": "2099-06-01T14:00:00"},
+            "segments": [{}],
+        }],
+        "price": {"total": {"amount": price, "currency": "NGN"}},
+    }
+
+
+# ten ordinary fares followed by five cheaper ones the parser must never reach
+PROVIDER_BODY = {"data": [provider_flight(f"Air{i}", 500 - i * 10) for i in range(10)]
+                 + [provider_flight(f"Late{i}", i + 1) for i in range(5)]}
+
+
+def test_streamed_provider_flights():
+    """The first 10 data items are parsed and the cheapest top_n come back in price order."""
+    query = {"from": "LOS", "to": "YYZ", "date": "2099-06-01"}
+    key = ("LOS", "YYZ", "2099-06-01", 1, "NGN")
+    handler = lambda request: httpx.Response(200, json=PROVIDER_BODY)
+
+    _FLIGHT_CACHE.pop(key, None)
+    result, calls = search_with_transport(handler, query)
+    assert calls == 1
+    assert "source" not in result["flights"]
+    assert len(_FLIGHT_CACHE[key]) == 10
+    assert [f["price"] for f in result["flights"]["flights"]] == [410, 420, 430]
+    assert [f["airline"] for f in result["flights"]["flights"]] == ["Air9", "Air8", "Air7"]
+    # an identical search is answered from the flight cache
+    repeat, calls = search_with_transport(handler, query)
+    assert calls == 0
+    assert repeat["flights"] == result["flights"]
+
+    _FLIGHT_CACHE.pop(key, None)
+    result, calls = search_with_transport(handler, query, mode="single")
+    assert [f["price"] for f in result["flights"]["flights"]] == [410]
+
+
+def test_flight_cache_ttl_by_departure():
+    """Fares close to departure expire within a minute; far-future ones after hours."""
+    today = date.today()
+    assert derive_ttl(today.isoformat()) == 60
+    assert derive_ttl((today + timedelta(days=5)).isoformat()) == 600
+    assert derive_ttl((today + timedelta(days=365)).isoformat()) == 21600
+    assert derive_ttl("not a date") == 600
+
+
+def test_provider_retry():
+    """A 503 with Retry-After is retried into a live result; a 404 is final."""
+    responses = iter([httpx.Response(503, headers={"Retry-After": "0"}), httpx.Response(200, json=PROVIDER_BODY)])
+    query = {"from": "LOS", "to": "SFO", "date": "2099-06-01"}
+    _FLIGHT_CACHE.pop(("LOS", "SFO", "2099-06-01", 1, "NGN"), None)
+    result, calls = search_with_transport(lambda request: next(responses), query)
+    assert calls == 2
+    assert "source" not in result["flights"]
+    assert result["flights"]["flights"][0]["price"] == 410
+
+    query = {"from": "LOS", "to": "LAX", "date": "2099-06-01"}
+    _FLIGHT_CACHE.pop(("LOS", "LAX", "2099-06-01", 1, "NGN"), None)
+    result, calls = search_with_transport(lambda request: httpx.Response(404), query)
+    assert calls == 1
+    assert result["flights"]["source"] == "mock"
+
+
+def test_negative_cache_on_provider_failure():
+    """A 503 or a 200 without flights is cached as a failure and answered with mock data."""
+    for dest, handler in (
+        ("CDG", lambda request: httpx.Response(503)),
+        ("JFK", lambda request: httpx.Response(200, json={"message": "quota exceeded"})),
+    ):
+        query = {"from": "LOS", "to": dest, "date": "2099-06-01"}
+        key = ("LOS", dest, "2099-06-01", 1, "NGN")
+        _FLIGHT_CACHE.pop(key, None)
+        result, calls = search_with_transport(handler, query)
+        assert calls >= 1
+        assert result["flights"]["source"] == "mock"
+        assert _FLIGHT_CACHE[key] is _NEG
+        # the repeat is served from the negative entry without a provider call
+        result, calls = search_with_transport(handler, query)
+        assert calls == 0 and result["flights"]["source"] == "mock"
+
+
+def test_agent_mode_from_env(monkeypatch):
+    """FLIGHT_AGENT_MODE reaches the agent the app builds."""
+    monkeypatch.setenv("FLIGHT_AGENT_MODE", "single")
+    agent = main._build_flight_agent()
+    assert agent.mode == "single"
+    result = asyncio.run(agent.process_messages({"query": {"from": "LOS", "to": "LHR"}}))
+    assert len(result["flights"]["flights"]) == 1
+
+
+def test_agent_http_client_per_loop():
+    """Each event loop gets its own client; cleanup only closes the running loop's."""
+    agent = FlightAgent()
+
+    async def client_of():
+        return agent._http()
+
+    first, second = asyncio.run(client_of()), asyncio.run(client_of())
+    assert first is not second
+
+    async def reopen_after_cleanup():
+        client = agent._http()
+        await agent.cleanup()
+        assert client.is_closed
+        assert not agent._http().is_closed
+        await agent.cleanup()
+
+    asyncio.run(reopen_after_cleanup())
+
+
+def test_unknown_agent_mode_falls_back(monkeypatch, caplog):
+    """A FLIGHT_AGENT_MODE typo is logged and the agent still builds in top3 mode."""
+    monkeypatch.setenv("FLIGHT_AGENT_MODE", "singel")
+    agent = main._build_flight_agent()
+    assert agent is not None and agent.mode == "top3"
+    assert "FLIGHT_AGENT_MODE" in caplog.text
+
+
 def test_using_helper_module():
     """Use the helper functions in agents/a2a_client to call the running TestClient app.
 
@@ -67,6 +345,8 @@ def test_using_helper_module():
 
 
 if __name__ == '__main__':
-    test_jsonrpc_direct()
-    test_message_parts_style()
+    client = TestClient(create_app())
+    test_jsonrpc_direct(client)
+    test_message_parts_style(client)
+    test_batched_queries(client)
     test_using_helper_module()